@@ -1,7 +1,12 @@
 import os
-import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import PySimpleGUI as sg
 import openai
+import orjson
+import requests
 import tiktoken
 
 # -----------------------------------------
@@ -10,112 +15,532 @@ import tiktoken
 OPENAI_API_KEY = "OPEN AI KEY"  # <-- Put your key here or handle via env var
 MODEL_NAME = "o1-mini-2024-09-12"   # e.g., "o1-mini-2024-09-12", "gpt-4o-mini", etc.
 CHUNK_SIZE = 3000                   # approximate max tokens per chunk
-HISTORY_JSON_PATH = "conversation_history.json"
+HISTORY_JSONL_PATH = "conversation_history.jsonl"
+LEGACY_HISTORY_JSON_PATH = "conversation_history.json"  # pre-JSONL format, imported once
+MODEL_CONTEXT = 128000              # context window of MODEL_NAME, in tokens
+RESERVED_OUTPUT_TOKENS = 4096       # room left for the model's reply
+CHUNKS_PER_MESSAGE = 4              # file chunks grouped into one user message
+REQUEST_TIMEOUT = (10, 600)         # (connect, read) seconds for chat requests
+STREAM_FLUSH_CHARS = 80             # push streamed text to the UI every N characters
 
 # Set API key
 openai.api_key = OPENAI_API_KEY
 
+# Delimiters used when several file chunks share a single message
+CHUNK_DELIMITER = "===CHUNK {index}===\n"
+CHUNK_BATCH_INSTRUCTION = "Respond with one block per ===CHUNK N=== in the same order."
+_CHUNK_REPLY_RE = re.compile(r"===CHUNK (\d+)===")
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model_name: str):
+    """
+    Load the tiktoken encoding for a model once per process.
+    Building the BPE tables is expensive, so repeat lookups hit the cache.
+    """
+    return tiktoken.encoding_for_model(model_name)
+
+
+# Load the default encoding at startup so the first chunking pass doesn't pay for it
+_ENC = _get_encoding(MODEL_NAME)
+
+# Sentence ends and blank lines; the separator is captured so it can be kept
+_SENT_RE = re.compile(r'((?<=[.!?])\s+|\n{2,})')
+
 
 def count_tokens(text: str, model_name: str = MODEL_NAME) -> int:
     """
     Uses tiktoken to approximate the number of tokens in a string
-    with the given model's encoding.
+    with the given model's encoding. Special-token text such as
+    <|endoftext|> is counted as ordinary text instead of raising.
+    """
+    return len(_get_encoding(model_name).encode_ordinary(text))
+
+
+def _encode_batch(texts: list[str], enc=_ENC) -> list[list[int]]:
+    """
+    Tokenize many strings with encode_ordinary, one call per string.
+    tiktoken's encode_ordinary_batch makes the same calls through a new
+    8-thread pool plus one Future per string, which is slower for the
+    short segments chunk_text produces. Files are already encoded in
+    parallel by load_and_chunk_files.
     """
-    encoding = tiktoken.encoding_for_model(model_name)
-    return len(encoding.encode(text))
+    return [enc.encode_ordinary(text) for text in texts]
 
 
-def chunk_text(text: str, max_tokens: int = CHUNK_SIZE) -> list[str]:
+def _split_segments(text: str) -> list[str]:
+    """
+    Split text at sentence ends and blank lines. The whitespace that
+    separated two segments stays attached to the first one, so joining
+    the segments back together reproduces the original text exactly.
+    """
+    parts = _SENT_RE.split(text)
+    # split() alternates [text, separator, text, separator, ..., text]
+    segments = [
+        parts[i] + (parts[i + 1] if i + 1 < len(parts) else "")
+        for i in range(0, len(parts), 2)
+    ]
+    return [seg for seg in segments if seg]
+
+
+def _hard_split(text: str, limit: int) -> list[str]:
+    """
+    Cut text into pieces of at most `limit` characters, breaking after the
+    last newline (or other whitespace) inside each window when there is
+    one. Joining the pieces reproduces the text exactly.
+    """
+    pieces = []
+    start = 0
+    while len(text) - start > limit:
+        window = text[start:start + limit]
+        cut = window.rfind("\n") + 1
+        if cut <= 0:
+            cut = max(window.rfind(c) for c in " \t\r\f\v") + 1
+        if cut <= 0:
+            cut = limit
+        pieces.append(text[start:start + cut])
+        start += cut
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def _fit_segments(segments: list[str], max_tokens: int, enc=_ENC) -> list[tuple[str, int]]:
+    """
+    Pair every segment with its token count, breaking up any segment that
+    would not fit in a single chunk: first at line boundaries, then at
+    whitespace, and only as a last resort at a character offset. Splits
+    are on str indices, so they never land inside a UTF-8 character.
+    """
+    # tiktoken is superlinear on very long inputs, so hard-split any
+    # segment that is far longer than a chunk could be before encoding it.
+    hard_char_limit = max_tokens * 8
+    pieces = []
+    for seg in segments:
+        if len(seg) > hard_char_limit:
+            pieces.extend(_hard_split(seg, hard_char_limit))
+        else:
+            pieces.append(seg)
+
+    fitted = []
+    for piece, tokens in zip(pieces, _encode_batch(pieces, enc)):
+        n_tokens = len(tokens)
+        if n_tokens <= max_tokens or len(piece) == 1:
+            fitted.append((piece, n_tokens))
+            continue
+
+        lines = piece.splitlines(keepends=True)
+        if len(lines) > 1:
+            sub_pieces = lines
+        else:
+            step = max(1, len(piece) * max_tokens // (n_tokens + 1))
+            sub_pieces = _hard_split(piece, step)
+        fitted.extend(_fit_segments(sub_pieces, max_tokens, enc))
+
+    return fitted
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_SIZE, min_tokens: int | None = None,
+               enc=_ENC) -> list[tuple[str, int]]:
     """
     Splits text into chunks that are each up to `max_tokens` tokens.
-    Returns a list of chunk strings.
+    Text is split at sentence/blank-line boundaries and the pieces are
+    packed greedily; a final chunk smaller than `min_tokens` (default
+    max_tokens // 4) is merged into or topped up from the previous one.
+    Returns a list of (chunk string, token count) pairs.
     """
-    paragraphs = text.split('\n')
+    if min_tokens is None:
+        min_tokens = max_tokens // 4
+
+    # Each chunk is a list of (segment, n_tokens) pairs plus its running total
     chunks = []
-    current_chunk = ""
+    current_parts = []
+    running_tokens = 0
 
-    for paragraph in paragraphs:
-        candidate = (current_chunk + "\n" + paragraph).strip()
-        if count_tokens(candidate) > max_tokens and current_chunk:
+    for segment, n_tokens in _fit_segments(_split_segments(text), max_tokens, enc):
+        if running_tokens + n_tokens > max_tokens and current_parts:
             # push the existing chunk
-            chunks.append(current_chunk)
-            current_chunk = paragraph
-        else:
-            if not current_chunk:
-                current_chunk = paragraph
+            chunks.append((current_parts, running_tokens))
+            current_parts = []
+            running_tokens = 0
+        current_parts.append((segment, n_tokens))
+        running_tokens += n_tokens
+
+    # Append any leftover text, avoiding a tiny trailing chunk
+    if current_parts:
+        if running_tokens < min_tokens and chunks:
+            prev_parts, prev_tokens = chunks.pop()
+            if prev_tokens + running_tokens <= max_tokens:
+                current_parts = prev_parts + current_parts
+                running_tokens += prev_tokens
             else:
-                current_chunk += "\n" + paragraph
+                # Too big to merge: move segments off the end of the previous chunk instead
+                while (running_tokens < min_tokens and len(prev_parts) > 1
+                       and running_tokens + prev_parts[-1][1] <= max_tokens):
+                    moved = prev_parts.pop()
+                    current_parts.insert(0, moved)
+                    running_tokens += moved[1]
+                    prev_tokens -= moved[1]
+                chunks.append((prev_parts, prev_tokens))
+        chunks.append((current_parts, running_tokens))
+
+    result = []
+    for parts, n_tokens in chunks:
+        chunk = "".join(segment for segment, _ in parts)
+        if chunk.strip():
+            result.append((chunk, n_tokens))
+    return result
+
+
+def batch_chunk_messages(chunks: list[tuple[str, int]],
+                         batch_size: int = CHUNKS_PER_MESSAGE) -> list[tuple[str, int]]:
+    """
+    Group (chunk, token count) pairs into messages of up to `batch_size`
+    chunks each, marked with ===CHUNK N=== delimiters (numbered across the
+    whole list) and asking for one answer block per chunk. Falls back to
+    one chunk per message when the chunks would not fit in the model's
+    context anyway. Returns (message, approximate token count) pairs.
+    """
+    if batch_size <= 1 or len(chunks) <= 1:
+        return list(chunks)
+    if sum(n_tokens for _, n_tokens in chunks) > MODEL_CONTEXT - RESERVED_OUTPUT_TOKENS:
+        return list(chunks)
+
+    instruction_tokens = count_tokens(CHUNK_BATCH_INSTRUCTION)
+    messages = []
+    for start in range(0, len(chunks), batch_size):
+        bodies = []
+        n_tokens = instruction_tokens
+        for index, (chunk, chunk_tokens) in enumerate(chunks[start:start + batch_size], start=start + 1):
+            delimiter = CHUNK_DELIMITER.format(index=index)
+            bodies.append(delimiter + chunk)
+            n_tokens += count_tokens(delimiter) + chunk_tokens
+        messages.append(("\n\n".join(bodies) + f"\n\n{CHUNK_BATCH_INSTRUCTION}", n_tokens))
+    return messages
+
+
+def parse_chunk_replies(reply: str) -> tuple[str, dict[int, str]]:
+    """
+    Split an assistant reply on ===CHUNK N=== markers.
+    Returns (text before the first marker, {chunk number: answer}); the
+    dict is empty if the reply has no markers.
+    """
+    parts = _CHUNK_REPLY_RE.split(reply)
+    # parts = [preamble, number, answer, number, answer, ...]
+    answers = {int(parts[i]): parts[i + 1].strip() for i in range(1, len(parts) - 1, 2)}
+    return parts[0].strip(), answers
 
-    # Append any leftover text
-    if current_chunk.strip():
-        chunks.append(current_chunk)
 
-    return chunks
+@lru_cache(maxsize=64)
+def _chunks_for(path: str, mtime_ns: int, size: int) -> tuple[tuple[str, int], ...]:
+    """
+    Chunk a file's contents. Keyed on modification time and size as well
+    as the path, so an edited file is re-read while an unchanged one is
+    served from the cache.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        code_content = f.read()
+    return tuple(chunk_text(code_content, CHUNK_SIZE))
+
+
+def _load_and_chunk(fp: str):
+    """
+    Read one file and split it into chunks. Returns (file name, chunks).
+    """
+    st = os.stat(fp)
+    return os.path.basename(fp), _chunks_for(fp, st.st_mtime_ns, st.st_size)
+
+
+def load_and_chunk_files(file_paths: list[str]):
+    """
+    Read and chunk several files in parallel on a thread pool.
+    Results come back in the same order as `file_paths`.
+    """
+    if not file_paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(8, len(file_paths))) as executor:
+        return list(executor.map(_load_and_chunk, file_paths))
 
 
 def load_or_init_history(filepath: str):
     """
-    Load conversation history from a local JSON file if exists;
-    otherwise return an empty structure.
+    Load conversation history from a local JSONL file (one message per
+    line) if exists; otherwise return an empty structure. Lines that
+    cannot be parsed, e.g. a partial write, are skipped.
     """
+    history = []
     if os.path.exists(filepath):
-        with open(filepath, "r", encoding="utf-8") as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return []
-    else:
-        return []
+        with open(filepath, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    msg = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue
+                # Drop cached keys (e.g. "_ntok") written by older versions;
+                # they may not match the current model's encoding
+                history.append({k: v for k, v in msg.items() if not k.startswith("_")})
+    return history
+
 
+def append_history(filepath: str, messages):
+    """
+    Append new messages to the local JSONL history file, one per line,
+    so each turn only writes what changed. Cached keys (those starting
+    with '_') are not persisted; token counts are recomputed after loading.
+    """
+    with open(filepath, "ab") as f:
+        f.writelines(
+            orjson.dumps({k: v for k, v in msg.items() if not k.startswith("_")}) + b"\n"
+            for msg in messages
+        )
 
-def save_history(filepath: str, history):
+
+def import_legacy_history(json_path: str, jsonl_path: str):
+    """
+    One-time migration from the old single-document JSON history: if the
+    JSONL file doesn't exist yet but the old file does, copy its messages
+    over. The old file is left untouched.
+    """
+    if os.path.exists(jsonl_path) or not os.path.exists(json_path):
+        return
+    with open(json_path, "rb") as f:
+        try:
+            history = orjson.loads(f.read())
+        except orjson.JSONDecodeError:
+            return
+    if isinstance(history, list):
+        append_history(jsonl_path, history)
+
+
+def clear_history(filepath: str):
     """
-    Save conversation history into a local JSON file.
+    Truncate the local JSONL history file.
     """
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+    open(filepath, "w", encoding="utf-8").close()
 
 
-def add_developer_message(history, content):
+def add_developer_message(history, content, ntok: int | None = None):
     """
     Add a developer (system-like) message to the conversation history array.
     Many newer models do not support the 'system' role.
+    `ntok` is the content's token count if already known.
     """
-    history.append({"role": "developer", "content": content})
+    if ntok is None:
+        ntok = count_tokens(content)
+    history.append({"role": "developer", "content": content, "_ntok": ntok})
 
 
-def add_user_message(history, content):
+def add_user_message(history, content, ntok: int | None = None):
     """
     Add a user message to the conversation history array.
+    `ntok` is the content's token count if already known.
     """
-    history.append({"role": "user", "content": content})
+    if ntok is None:
+        ntok = count_tokens(content)
+    history.append({"role": "user", "content": content, "_ntok": ntok})
 
 
-def add_assistant_message(history, content):
+def add_assistant_message(history, content, ntok: int | None = None):
     """
     Add an assistant message (the model response) to the conversation history array.
+    `ntok` is the content's token count if already known.
+    """
+    if ntok is None:
+        ntok = count_tokens(content)
+    history.append({"role": "assistant", "content": content, "_ntok": ntok})
+
+
+def _message_tokens(msg) -> int:
+    """
+    Token count of a message's content. The add_*_message helpers store it
+    as "_ntok" up front; this fills it in for messages that lack it.
+    """
+    if "_ntok" not in msg:
+        msg["_ntok"] = count_tokens(msg["content"])
+    return msg["_ntok"]
+
+
+def _api_messages(history):
+    """
+    Strip local bookkeeping keys (those starting with '_') before a
+    history is sent to the API.
+    """
+    return [{k: v for k, v in msg.items() if not k.startswith("_")} for msg in history]
+
+
+def _message_json(msg) -> bytes:
+    """
+    The API view of a message serialized to JSON. Messages don't change
+    once added, so the bytes are cached on the message as "_json" and each
+    turn only serializes what is new.
     """
-    history.append({"role": "assistant", "content": content})
+    if "_json" not in msg:
+        msg["_json"] = orjson.dumps(_api_messages([msg])[0])
+    return msg["_json"]
+
+
+def _chat_request_body(history) -> bytes:
+    """
+    Assemble the Chat Completion request body from the cached per-message JSON.
+    """
+    return (
+        b'{"model":' + orjson.dumps(MODEL_NAME)
+        + b',"temperature":1,"stream":true,"messages":['  # temperature must be 1 for o1 models
+        + b",".join(_message_json(msg) for msg in history)
+        + b"]}"
+    )
+
+
+def trim_history(history, budget: int, keep_last: int = 1):
+    """
+    Sliding window over the conversation: keep the most recent messages
+    whose combined token count fits in `budget`, always keeping the
+    initial developer message and the last `keep_last` messages (the
+    ones being sent this turn). Only earlier turns slide out of the
+    window; raises ValueError if the required messages alone don't fit,
+    rather than sending a request without part of them.
+    """
+    if not history:
+        return []
+
+    head = history[:1] if history[0]["role"] == "developer" else []
+    body = history[len(head):]
+    split = max(0, len(body) - keep_last)
+    earlier, required = body[:split], body[split:]
+
+    head_tokens = sum(_message_tokens(msg) for msg in head)
+    required_tokens = sum(_message_tokens(msg) for msg in required)
+    if head_tokens + required_tokens > budget:
+        raise ValueError(
+            f"The new messages are too long to send ({required_tokens} tokens; "
+            f"the limit is {budget - head_tokens}). Send fewer files or a shorter prompt."
+        )
+
+    used = head_tokens + required_tokens
+    kept = []
+    for msg in reversed(earlier):
+        n_tokens = _message_tokens(msg)
+        if used + n_tokens > budget:
+            break
+        kept.append(msg)
+        used += n_tokens
+    kept.reverse()
+    return head + kept + required
 
 
 def send_chat_completion(history):
     """
-    Send the conversation history to the Chat Completion endpoint for the selected model.
+    Send the conversation history to the Chat Completion endpoint for the selected model,
+    streaming the reply: yields the text deltas as they arrive.
+    The request body is posted pre-serialized (see _chat_request_body)
+    rather than through the SDK, which would re-encode every message.
     NOTE: For o1-mini, some parameters (like temperature) might not be supported
     or must be set to default = 1.
     """
-    # The minimal set of parameters for an o1-mini call
-    response = openai.ChatCompletion.create(
-        model=MODEL_NAME,
-        messages=history,
-        temperature=1  # Must be 1 for o1 models that don't allow changes
+    response = requests.post(
+        f"{openai.api_base}/chat/completions",
+        data=_chat_request_body(history),
+        headers={
+            "Authorization": f"Bearer {openai.api_key}",
+            "Content-Type": "application/json",
+        },
+        stream=True,
+        timeout=REQUEST_TIMEOUT
     )
-    return response.choices[0].message["content"]
+    with response:
+        if response.status_code != 200:
+            try:
+                message = orjson.loads(response.content)["error"]["message"]
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                message = response.text
+            raise openai.error.APIError(message, http_status=response.status_code)
+
+        # Server-sent events: one "data: {...}" line per delta
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            payload = line[len(b"data: "):]
+            if payload == b"[DONE]":
+                break
+            event = orjson.loads(payload)
+            if "error" in event:
+                error = event["error"] or {}
+                message = error.get("message") if isinstance(error, dict) else str(error)
+                raise openai.error.APIError(message or "The stream returned an error.")
+            choices = event.get("choices")
+            if choices:
+                yield choices[0].get("delta", {}).get("content") or ""
+
+
+def _send_pipeline(window, history, file_paths, user_prompt):
+    """
+    Runs the whole Send pipeline on a background thread so the GUI stays
+    responsive: read and chunk the files, build the new user messages,
+    trim the conversation and stream the reply.
+
+    `history` is a snapshot of the conversation taken when Send was
+    pressed. The new messages are posted as a -MESSAGES- event (together
+    with the chunk labels) for the event loop to record; partial text is
+    posted as -STREAM- events every STREAM_FLUSH_CHARS characters, and
+    the full reply (or the exception) follows as -RESULT-. If it fails
+    before -MESSAGES- is posted, nothing was recorded, so the prompt and
+    files are handed back in a -SEND_FAILED- event to be restored.
+    """
+    parts = []
+    buffer = ""
+    messages_posted = False
+    try:
+        # 1. If there are newly selected files, chunk & add them
+        new_messages = []
+        chunk_labels = []
+        file_chunks = []
+        for name, code_chunks in load_and_chunk_files(file_paths):
+            for idx, (chunk, chunk_tokens) in enumerate(code_chunks, start=1):
+                label = f"[FILE: {name}, PART {idx}]"
+                chunk_labels.append(label)
+                file_chunks.append((f"{label}\n{chunk}", count_tokens(label) + 1 + chunk_tokens))
+        for chunk_msg, chunk_tokens in batch_chunk_messages(file_chunks):
+            add_user_message(new_messages, chunk_msg, chunk_tokens)
+
+        # 2. If user typed an actual prompt, add it
+        if user_prompt:
+            add_user_message(new_messages, user_prompt)
+
+        # 3. Keep the most recent part of the conversation that fits the
+        #    context window, and serialize it before handing the new
+        #    messages to the GUI thread, which saves them to disk
+        request_history = trim_history(
+            history + new_messages, MODEL_CONTEXT - RESERVED_OUTPUT_TOKENS, keep_last=len(new_messages)
+        )
+        for msg in request_history:
+            _message_json(msg)
+        window.write_event_value("-MESSAGES-", (new_messages, chunk_labels))
+        messages_posted = True
+
+        # 4. Send it to the model
+        for delta in send_chat_completion(request_history):
+            parts.append(delta)
+            buffer += delta
+            if len(buffer) >= STREAM_FLUSH_CHARS:
+                window.write_event_value("-STREAM-", buffer)
+                buffer = ""
+        if buffer:
+            window.write_event_value("-STREAM-", buffer)
+        result = "".join(parts)
+    except Exception as e:
+        result = e
+        if not messages_posted:
+            window.write_event_value("-SEND_FAILED-", (user_prompt, file_paths))
+    window.write_event_value("-RESULT-", result)
 
 
 def main():
     # Load existing conversation or start fresh
-    conversation_history = load_or_init_history(HISTORY_JSON_PATH)
+    import_legacy_history(LEGACY_HISTORY_JSON_PATH, HISTORY_JSONL_PATH)
+    conversation_history = load_or_init_history(HISTORY_JSONL_PATH)
+    saved_count = len(conversation_history)  # messages already written to disk
 
     # If conversation is empty, add a "developer" message with instructions
     if not conversation_history:
@@ -125,7 +550,8 @@ def main():
             "Your role is 'developer', which is like a system role for some models."
         )
         add_developer_message(conversation_history, initial_instructions)
-        save_history(HISTORY_JSON_PATH, conversation_history)
+        append_history(HISTORY_JSONL_PATH, conversation_history)
+        saved_count = len(conversation_history)
 
     # ----------------------------------
     # PySimpleGUI Layout
@@ -151,6 +577,8 @@ def main():
 
     window = sg.Window("o1-mini Developer Agent", layout, resizable=True)
     loaded_files = []
+    pending_chunk_labels = []  # [FILE: ..., PART n] labels of chunks in the in-flight request
+    request_in_flight = False  # Send/Clear Conversation are ignored until -RESULT- arrives
 
     while True:
         event, values = window.read()
@@ -182,48 +610,88 @@ def main():
             window["-FILES-"].update("")
 
         elif event == "-CLEAR_CONVO-":
+            # A click queued before the button was disabled must not clear
+            # the history the pending reply is about to be added to
+            if request_in_flight:
+                continue
             conversation_history = []
-            save_history(HISTORY_JSON_PATH, conversation_history)
+            clear_history(HISTORY_JSONL_PATH)
+            saved_count = 0
             window["-RESPONSE-"].update("")
             sg.popup("Conversation cleared. Next prompt will start fresh developer instructions.")
 
         elif event == "-SEND-":
+            if request_in_flight:
+                continue
             user_prompt = values["-PROMPT-"].strip()
             if not user_prompt and not loaded_files:
                 sg.popup("Please either enter a prompt or load files to send.")
                 continue
 
-            # 1. If there are newly selected files, chunk & add them
-            for fp in loaded_files:
-                with open(fp, "r", encoding="utf-8") as f:
-                    code_content = f.read()
-                code_chunks = chunk_text(code_content, CHUNK_SIZE)
-                for idx, chunk in enumerate(code_chunks, start=1):
-                    chunk_msg = f"[FILE: {os.path.basename(fp)}, PART {idx}]\n{chunk}"
-                    add_user_message(conversation_history, chunk_msg)
+            # Files are read, chunked and sent on a worker thread; the
+            # buttons that would change the conversation meanwhile are disabled
+            request_in_flight = True
+            window["-SEND-"].update(disabled=True)
+            window["-CLEAR_CONVO-"].update(disabled=True)
+            window["-RESPONSE-"].update("")
+            threading.Thread(
+                target=_send_pipeline,
+                args=(window, list(conversation_history), list(loaded_files), user_prompt),
+                daemon=True
+            ).start()
 
             # Clear the loaded file list to avoid re-sending the same code repeatedly
             loaded_files = []
             window["-FILES-"].update("")
+            # Clear the user prompt
+            window["-PROMPT-"].update("")
 
-            # 2. If user typed an actual prompt, add it
-            if user_prompt:
-                add_user_message(conversation_history, user_prompt)
-
-            # 3. Send conversation to the model
-            try:
-                answer = send_chat_completion(conversation_history)
+        elif event == "-MESSAGES-":
+            # Record and save the messages the worker is sending
+            new_messages, pending_chunk_labels = values["-MESSAGES-"]
+            conversation_history.extend(new_messages)
+            append_history(HISTORY_JSONL_PATH, conversation_history[saved_count:])
+            saved_count = len(conversation_history)
+
+        elif event == "-SEND_FAILED-":
+            # Nothing from this Send was recorded: give the prompt and files
+            # back, without overwriting anything entered in the meantime
+            failed_prompt, failed_files = values["-SEND_FAILED-"]
+            if failed_prompt and not values["-PROMPT-"].strip():
+                window["-PROMPT-"].update(failed_prompt)
+            loaded_files = failed_files + [fp for fp in loaded_files if fp not in failed_files]
+            window["-FILES-"].update("\n".join(loaded_files))
+
+        elif event == "-STREAM-":
+            window["-RESPONSE-"].update(values["-STREAM-"], append=True)
+
+        elif event == "-RESULT-":
+            result = values["-RESULT-"]
+            if isinstance(result, Exception):
+                answer = f"Error: {str(result)}"
+            else:
+                answer = result
                 add_assistant_message(conversation_history, answer)
-            except Exception as e:
-                answer = f"Error: {str(e)}"
-
-            # 4. Show the assistant response in the UI
+                append_history(HISTORY_JSONL_PATH, conversation_history[saved_count:])
+                saved_count = len(conversation_history)
+
+                # Label per-chunk answers with the file/part they belong to
+                preamble, chunk_replies = parse_chunk_replies(answer)
+                labeled = [
+                    f"{pending_chunk_labels[num - 1]}\n{text}"
+                    for num, text in sorted(chunk_replies.items())
+                    if 1 <= num <= len(pending_chunk_labels)
+                ]
+                if labeled:
+                    # Keep any summary or prompt answer given before the first marker
+                    answer = "\n\n".join(([preamble] if preamble else []) + labeled)
+            pending_chunk_labels = []
+
+            # Show the assistant response in the UI
             window["-RESPONSE-"].update(answer)
-
-            # 5. Save the new conversation state
-            save_history(HISTORY_JSON_PATH, conversation_history)
-            # 6. Clear the user prompt
-            window["-PROMPT-"].update("")
+            request_in_flight = False
+            window["-SEND-"].update(disabled=False)
+            window["-CLEAR_CONVO-"].update(disabled=False)
 
         elif event == "-SAVE_OUTPUT-":
             save_path = sg.popup_get_file(
@@ -234,11 +702,13 @@ def main():
             )
             if save_path:
                 try:
+                    # Build the whole text first so the file is written in one call
+                    output = "".join(
+                        f"{msg['role'].upper()}:\n{msg['content']}\n\n"
+                        for msg in conversation_history
+                    )
                     with open(save_path, "w", encoding="utf-8") as f:
-                        for msg in conversation_history:
-                            role = msg["role"].upper()
-                            content = msg["content"]
-                            f.write(f"{role}:\n{content}\n\n")
+                        f.write(output)
                     sg.popup(f"Conversation saved to {save_path}")
                 except Exception as e:
                     sg.popup(f"Failed to save file: {str(e)}")